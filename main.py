@@ -1,108 +1,804 @@
 import asyncio
 from typing import Annotated
-import json
+import base64
+import hashlib
+import os
 import sys
+import tempfile
+import time
 import traceback
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache, partial
+from io import BytesIO
 from pathlib import Path
-from typing import List, Literal, Optional
+from typing import Awaitable, Callable, Dict, List, Literal, Optional, Tuple
 import re
 
-import PyPDF2
+import anthropic
+import httpx
+import pydantic_core
+import pypdfium2 as pdfium
 import argparse
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 from pydantic_ai import Agent, RunContext
+from pydantic_ai.exceptions import UnexpectedModelBehavior
 from pydantic_ai.models.anthropic import AnthropicModel
 from pydantic_ai.usage import UsageLimits
+from tenacity import RetryCallState, retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Load environment variables
 load_dotenv()
 
 # Define the data model for publication details
 class PublicationDetail(BaseModel):
-    publication_name: Literal['activist', 'transport worker', 'national conference', 'other']
+    publication_name: Annotated[
+        Literal['activist', 'transport worker', 'national conference', 'other'],
+        Field(serialization_alias='publication'),
+    ]
     date: Annotated[str, Field(description='The date of the publication in MM/YYYY or YYYY format.')]
     headline: Annotated[str, Field(description='The headline of the publication. It should not be all capital letters.')]
 
-# Initialize the AI model
-model = AnthropicModel('claude-3-5-sonnet-latest')
+DEFAULT_MODEL = 'claude-3-5-haiku-latest'
+DEFAULT_FALLBACK_MODEL = 'claude-3-5-sonnet-latest'
+
+# The tool call input is well under 150 tokens; decode time grows with this cap
+MAX_RESPONSE_TOKENS = 256
+
+# Bump whenever the prompts change so stale cache entries are ignored
+PROMPT_VERSION = 'v2'
+
+# Disk cache of extracted details, keyed by file content, prompt version, request kind and model
+CACHE_DIR = Path('.llm_cache')
+CACHE_TTL = 7 * 24 * 60 * 60
+
+# Maximum number of PDFs prepared ahead of the extractions consuming them
+MAX_QUEUED_PDFS = 32
+
+# Minimum number of characters of extracted text for a raw request to skip the PDF upload
+MIN_TEXT_LENGTH = 50
+
+# Transient API errors (rate limited, overloaded, server errors) are retried with backoff
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504, 529}
+MAX_ATTEMPTS = 6
+
+# Message Batches API limits on a single batch; the size is kept under 256 MB to leave room for the envelope
+MAX_BATCH_REQUESTS = 100_000
+MAX_BATCH_BYTES = 250 * 1024 * 1024
+
+# Seconds to wait between status checks of a submitted message batch
+BATCH_POLL_INTERVAL = 5
+
+RAW_INSTRUCTIONS = (
+    'Please analyze this document and record its publication details with the `record_publication` tool.'
+)
+
+# Forced tool call so that Claude returns the details as structured input rather than free text
+RECORD_PUBLICATION_TOOL = {
+    "name": "record_publication",
+    "description": "Record the publication details extracted from the document.",
+    "input_schema": PublicationDetail.model_json_schema(),
+}
+
+# A PDF read and parsed locally, ready to be sent to Claude
+@dataclass
+class PreparedPdf:
+    path: Path
+    digest: str
+    # Only extracted when a raw or batch request uploads the PDF, see prepare_pdf
+    first_page: Optional[bytes]
+    text: str
+
+# Shared HTTP client so that connections and TLS sessions are reused across all requests
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+    timeout=httpx.Timeout(120.0, connect=10.0),
+)
+
+# Shared Anthropic client used by both the raw backend and the agent's models.
+# Retries are handled by api_retry below rather than by the SDK.
+client = anthropic.AsyncAnthropic(http_client=http_client, max_retries=0)
+
+def is_retryable(exc: BaseException) -> bool:
+    """
+    Check whether an API error is transient and worth retrying.
+    
+    Args:
+        exc: Exception raised by an API call
+    
+    Returns:
+        True for connection errors and retryable HTTP status codes
+    """
+    if isinstance(exc, anthropic.APIConnectionError):
+        return True
+    # pydantic_ai's ModelHTTPError carries status_code just like anthropic.APIStatusError
+    return getattr(exc, 'status_code', None) in RETRYABLE_STATUS_CODES
+
+_wait_backoff = wait_random_exponential(min=1, max=60)
+
+def wait_retry_after(retry_state: RetryCallState) -> float:
+    """
+    Wait for the duration in the response's retry-after header, falling back to exponential backoff.
+    
+    Args:
+        retry_state: State of the call being retried
+    
+    Returns:
+        Number of seconds to wait before the next attempt
+    """
+    exc = retry_state.outcome.exception()
+    # pydantic_ai raises ModelHTTPError from the original anthropic error, which has the response
+    for error in (exc, exc.__cause__):
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return _wait_backoff(retry_state)
+
+def log_retry(retry_state: RetryCallState) -> None:
+    """
+    Log a failed attempt before waiting to retry it.
+    
+    Args:
+        retry_state: State of the call being retried
+    """
+    print(f"Retrying after attempt {retry_state.attempt_number} failed: {retry_state.outcome.exception()}")
+
+api_retry = retry(
+    retry=retry_if_exception(is_retryable),
+    wait=wait_retry_after,
+    stop=stop_after_attempt(MAX_ATTEMPTS),
+    before_sleep=log_retry,
+    reraise=True,
+)
 
-# Create the agent with the specified configuration
+# Create the agent with the specified configuration; the model is chosen per run
 agent = Agent(
-    model,
     result_type=PublicationDetail,
-    deps_type=str,
+    deps_type=PreparedPdf,
     system_prompt=(
         'use the `get_pdf_content` tool to get the PDF content and then extract the publication details'
     ),
 )
 
 @agent.tool  
-def get_pdf_content(ctx: RunContext[str]) -> str:
+def get_pdf_content(ctx: RunContext[PreparedPdf]) -> str:
     """
-    Extract text content from a PDF file.
+    Get the text content of the first page of a PDF file.
     
     Args:
-        ctx: RunContext containing the file path as deps
+        ctx: RunContext containing the prepared PDF as deps
     
     Returns:
         Extracted text content or error message
     """
-    file_path = ctx.deps
-    print(f"Processing: {file_path}")
+    prepared = ctx.deps
+    print(f"Processing: {prepared.path}")
+    
+    text_content = prepared.text
+    print(f"Extracted {len(text_content)} characters of text")
+    
+    if not text_content or len(text_content) < 10:
+        return "PDF appears to be image-based or has limited text content. Consider using OCR for better results."
+    
+    return text_content
+
+def get_first_page_pdf(pdf: pdfium.PdfDocument, pdf_path: Path) -> bytes:
+    """
+    Extract the first page of a PDF file as a standalone PDF.
+    
+    Args:
+        pdf: Document opened on the PDF file
+        pdf_path: Path to the PDF file
+    
+    Returns:
+        Bytes of a PDF containing only the first page
+    """
+    # Single page PDFs can be sent as they are, without re-serializing
+    if len(pdf) == 1:
+        return pdf_path.read_bytes()
+    
+    with pdfium.PdfDocument.new() as first_page_pdf:
+        first_page_pdf.import_pages(pdf, [0])
+        first_page_bytes = BytesIO()
+        first_page_pdf.save(first_page_bytes)
+    return first_page_bytes.getvalue()
+
+def get_file_digest(pdf_path: Path) -> str:
+    """
+    Compute the SHA-256 digest of a file without loading it into memory at once.
+    
+    Args:
+        pdf_path: Path to the file
+    
+    Returns:
+        Hex digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def needs_upload(text: str, always_pdf: bool = False) -> bool:
+    """
+    Check whether a raw or batch request sends the first page as a document rather than its text.
+    
+    Args:
+        text: Text extracted from the first page
+        always_pdf: Send the first page as a document even if it has usable text
+    
+    Returns:
+        True if the first page PDF is uploaded
+    """
+    return always_pdf or len(text.strip()) <= MIN_TEXT_LENGTH
+
+def prepare_pdf(pdf_path: Path, with_first_page: bool = False, always_pdf: bool = False) -> PreparedPdf:
+    """
+    Read a PDF file and extract its text, and its first page if the request will upload it.
+    
+    This is CPU-bound and runs in a worker process so that parsing overlaps with API calls.
+    
+    Args:
+        pdf_path: Path to the PDF file
+        with_first_page: Extract the first page as a standalone PDF if a raw or batch request would upload it
+        always_pdf: Send the first page as a document even if it has usable text
+    
+    Returns:
+        PreparedPdf for the file
+    """
+    # PDFium reads the file itself, so it is never loaded into a Python buffer
+    with pdfium.PdfDocument(pdf_path) as pdf:
+        if len(pdf) == 0:
+            raise ValueError("PDF has no pages")
+        
+        text = pdf[0].get_textpage().get_text_range()
+        # Text PDFs are sent as text, so their first page is not extracted only to be thrown away
+        first_page = None
+        if with_first_page and needs_upload(text, always_pdf):
+            first_page = get_first_page_pdf(pdf, pdf_path)
+        # A single page PDF is sent as it is, so its bytes are already in memory and need not be read again
+        if first_page is not None and len(pdf) == 1:
+            digest = hashlib.sha256(first_page).hexdigest()
+        else:
+            digest = get_file_digest(pdf_path)
+        
+        return PreparedPdf(
+            path=pdf_path,
+            digest=digest,
+            first_page=first_page,
+            text=text,
+        )
+
+@lru_cache
+def get_model(model_name: str) -> AnthropicModel:
+    """
+    Get the AI model with the given name, using the shared Anthropic client.
+    
+    Args:
+        model_name: Name of the Anthropic model
+    
+    Returns:
+        AnthropicModel instance, reused across calls
+    """
+    return AnthropicModel(model_name, anthropic_client=client)
+
+def get_request_kind(backend: str, always_pdf: bool = False) -> str:
+    """
+    Name the prompt and request shape used for each PDF, so that backends never share cache entries.
+    
+    Args:
+        backend: Extraction backend, with batch requests counting as raw ones
+        always_pdf: Whether raw requests send the first page as a document even if it has usable text
+    
+    Returns:
+        Request kind included in the cache key
+    """
+    if backend == 'raw' and always_pdf:
+        return 'raw-pdf'
+    return backend
+
+def get_cache_file(digest: str, model_name: str, request_kind: str) -> Path:
+    """
+    Get the cache file for a PDF under the current prompt version, request kind and model.
     
+    The key uses the digest of the source file rather than the extracted first page,
+    because PDFium writes a new random document ID every time it saves a PDF.
+    
+    Args:
+        digest: Digest of the PDF file
+        model_name: Name of the model used to process the PDF
+        request_kind: Request kind from get_request_kind
+    
+    Returns:
+        Path of the cache file, which may not exist
+    """
+    key = hashlib.sha256(f"{digest}{PROMPT_VERSION}{request_kind}{model_name}".encode()).hexdigest()
+    return CACHE_DIR / f"{key}.json"
+
+def read_cache(cache_file: Path) -> Optional[PublicationDetail]:
+    """
+    Load cached publication details if the cache file exists and has not expired.
+    
+    Args:
+        cache_file: Path of the cache file
+    
+    Returns:
+        Cached PublicationDetail object or None on a cache miss
+    """
     try:
-        with open(file_path, "rb") as f:
-            pdf_reader = PyPDF2.PdfReader(f)
-            
-            if len(pdf_reader.pages) == 0:
-                return "PDF has no pages"
-                
-            text_content = pdf_reader.pages[0].extract_text()
-            print(f"Extracted {len(text_content)} characters of text")
+        if time.time() - cache_file.stat().st_mtime > CACHE_TTL:
+            return None
+        # Validated straight from bytes by pydantic-core, without a separate json.loads pass
+        return PublicationDetail.model_validate_json(cache_file.read_bytes())
+    except Exception:
+        return None
+
+def write_cache(cache_file: Path, detail: PublicationDetail) -> None:
+    """
+    Atomically write publication details to the cache.
+    
+    Args:
+        cache_file: Path of the cache file
+        detail: Extracted publication details
+    """
+    CACHE_DIR.mkdir(exist_ok=True)
+    # Identical PDFs share a cache key, so each writer needs its own temporary file
+    tmp_file = tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix='.tmp', delete=False)
+    try:
+        with tmp_file:
+            tmp_file.write(pydantic_core.to_json(detail, by_alias=False))
+        os.replace(tmp_file.name, cache_file)
+    except BaseException:
+        os.unlink(tmp_file.name)
+        raise
+
+def save_result(pdf_path: Path, detail: PublicationDetail) -> Path:
+    """
+    Save the extracted publication details next to the PDF file.
+    
+    Args:
+        pdf_path: Path to the PDF file
+        detail: Extracted publication details
+    
+    Returns:
+        Path of the written .txt file
+    """
+    txt_filename = pdf_path.with_suffix('.txt')
+    # Write to a temporary file first so an interrupted run never leaves a partial .txt behind
+    tmp_filename = txt_filename.with_suffix('.txt.tmp')
+    # pydantic-core serializes straight to UTF-8 bytes, so no str round-trip or text encoding is needed
+    tmp_filename.write_bytes(pydantic_core.to_json(detail, indent=2, by_alias=True))
+    os.replace(tmp_filename, txt_filename)
+    return txt_filename
+
+async def store_result(pdf_path: Path, cache_file: Path, detail: PublicationDetail) -> Path:
+    """
+    Save newly extracted publication details and add them to the cache.
+    
+    A failed cache write is only logged, because the result has already been saved.
+    
+    Args:
+        pdf_path: Path to the PDF file
+        cache_file: Path of the cache file
+        detail: Extracted publication details
+    
+    Returns:
+        Path of the written .txt file
+    """
+    txt_filename = await asyncio.to_thread(save_result, pdf_path, detail)
+    try:
+        await asyncio.to_thread(write_cache, cache_file, detail)
+    except OSError as e:
+        print(f"Failed to cache result for {pdf_path.name}: {e}")
+    return txt_filename
+
+def build_message(prepared: PreparedPdf, always_pdf: bool = False) -> dict:
+    """
+    Build the user message sent to Claude for a single PDF in a raw or batch request.
+    
+    PDFs with a usable text layer are sent as text, which costs far fewer input tokens
+    than the PDF itself. Image-based PDFs fall back to sending the first page as a document.
+    
+    Args:
+        prepared: PDF file prepared by prepare_pdf
+        always_pdf: Send the first page as a document even if it has usable text
+    
+    Returns:
+        Message dict containing the first page text or PDF and its filename
+    """
+    text_content = prepared.text.strip()
+    if not needs_upload(text_content, always_pdf):
+        return {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": f"filename: {prepared.path.name}\n\n{text_content}",
+                },
+            ],
+        }
+    
+    return {
+        "role": "user",
+        "content": [
+            {
+                "type": "document",
+                "source": {
+                    "type": "base64",
+                    "media_type": "application/pdf",
+                    "data": base64.standard_b64encode(prepared.first_page).decode("ascii"),
+                },
+            },
+            {
+                "type": "text",
+                "text": f"filename: {prepared.path.name}",
+            },
+        ],
+    }
+
+def build_message_params(prepared: PreparedPdf, model_name: str, always_pdf: bool = False) -> dict:
+    """
+    Build the Messages API parameters for a single PDF, forcing a `record_publication` tool call.
+    
+    Args:
+        prepared: PDF file prepared by prepare_pdf
+        model_name: Name of the model to process the PDF with
+        always_pdf: Send the first page as a document even if it has usable text
+    
+    Returns:
+        Keyword arguments for `client.messages.create`, also used as batch request params
+    """
+    return {
+        "model": model_name,
+        "max_tokens": MAX_RESPONSE_TOKENS,
+        "tools": [RECORD_PUBLICATION_TOOL],
+        "tool_choice": {"type": "tool", "name": RECORD_PUBLICATION_TOOL["name"]},
+        # The instructions are identical for every PDF, so mark them for prompt caching
+        "system": [
+            {
+                "type": "text",
+                "text": RAW_INSTRUCTIONS,
+                "cache_control": {"type": "ephemeral"},
+            },
+        ],
+        "messages": [build_message(prepared, always_pdf)],
+    }
+
+def parse_message(message: anthropic.types.Message) -> PublicationDetail:
+    """
+    Parse the publication details from the `record_publication` tool call in a response.
+    
+    Args:
+        message: Response from the Messages API
+    
+    Returns:
+        Validated PublicationDetail object
+    """
+    tool_use = next((block for block in message.content if block.type == "tool_use"), None)
+    # Raised as UnexpectedModelBehavior so that it is retried with the fallback model like a validation error
+    if tool_use is None:
+        raise UnexpectedModelBehavior(f"No record_publication tool call (stop reason {message.stop_reason})")
+    return PublicationDetail.model_validate(tool_use.input)
+
+async def submit_batch(requests: List[dict]) -> str:
+    """
+    Submit requests to the Message Batches API.
+    
+    Args:
+        requests: Batch requests, each with a custom ID and Messages API params
+    
+    Returns:
+        ID of the submitted batch
+    """
+    batch = await api_retry(client.messages.batches.create)(requests=requests)
+    print(f"Submitted batch {batch.id} with {len(requests)} PDFs")
+    return batch.id
+
+async def collect_batch(
+    batch_id: str,
+    entries: Dict[str, Tuple[Path, Path]],
+) -> Tuple[int, int, List[Tuple[Path, Path]]]:
+    """
+    Wait for a submitted batch to end, then save and cache its results.
+    
+    Args:
+        batch_id: ID of the submitted batch
+        entries: PDF file and cache file for each custom ID in the batch
+    
+    Returns:
+        Tuple of (successful, failed) counts and the PDF and cache files of results that failed validation
+    """
+    successful = 0
+    failed = 0
+    invalid = []
+    try:
+        batch = await api_retry(client.messages.batches.retrieve)(batch_id)
+        while batch.processing_status != "ended":
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+            batch = await api_retry(client.messages.batches.retrieve)(batch_id)
+        
+        async for entry in await api_retry(client.messages.batches.results)(batch_id):
+            pdf_path, cache_file = entries[entry.custom_id]
+            if entry.result.type != "succeeded":
+                print(f"Failed to process {pdf_path.name}: batch result {entry.result.type}")
+                failed += 1
+                continue
             
-            if not text_content or len(text_content) < 10:
-                return "PDF appears to be image-based or has limited text content. Consider using OCR for better results."
+            try:
+                message = entry.result.message
+                detail = parse_message(message)
+            except (UnexpectedModelBehavior, ValidationError) as e:
+                print(f"Failed to parse result for {pdf_path.name}: {e}")
+                invalid.append((pdf_path, cache_file))
+                continue
             
-            return text_content
+            print(f"Result for {pdf_path.name}:")
+            print(detail)
+            print(message.usage)
+            # One failed save must not abandon the remaining results, which are already paid for
+            try:
+                txt_filename = await store_result(pdf_path, cache_file, detail)
+            except Exception as e:
+                print(f"Failed to save result for {pdf_path.name}: {e}")
+                failed += 1
+                continue
+            print(f"Successfully created {txt_filename} with the JSON response")
+            successful += 1
     except Exception as e:
-        return f"Error processing PDF: {str(e)}"
+        # Every entry not yet saved is counted as failed
+        print(f"Failed to collect results of batch {batch_id}: {e}")
+        failed = len(entries) - successful - len(invalid)
+    
+    return successful, failed, invalid
 
-async def process_pdf(pdf_path: Path) -> Optional[PublicationDetail]:
+async def process_batch(
+    pdf_files: List[Path],
+    pool: ProcessPoolExecutor,
+    model_name: str,
+    fallback_model_name: Optional[str] = None,
+    always_pdf: bool = False,
+) -> Tuple[int, int]:
+    """
+    Process PDF files with the Message Batches API.
+    
+    PDFs are prepared MAX_QUEUED_PDFS at a time and their requests submitted as soon as
+    a batch would exceed the API's request count or size limit, so only one batch of
+    requests is held in memory at once. Results are collected once every batch is submitted,
+    and those that fail validation are retried one by one with the fallback model.
+    
+    Args:
+        pdf_files: PDF files to process
+        pool: Process pool used to prepare the PDF files
+        model_name: Name of the model used to process the PDFs
+        fallback_model_name: Name of the model to retry with if a result fails validation
+        always_pdf: Send every PDF as a document even if it has usable text
+    
+    Returns:
+        Tuple of (successful, failed) counts
+    """
+    loop = asyncio.get_running_loop()
+    prepare = partial(prepare_pdf, with_first_page=True, always_pdf=always_pdf)
+    # Batch requests are identical to raw ones, so they share cache entries
+    request_kind = get_request_kind('raw', always_pdf)
+    successful = 0
+    failed = 0
+    # Submitted batch IDs, each with the PDF and cache file for its custom IDs
+    batches: List[Tuple[str, Dict[str, Tuple[Path, Path]]]] = []
+    requests: List[dict] = []
+    requests_size = 0
+    entries: Dict[str, Tuple[Path, Path]] = {}
+    
+    async def submit() -> None:
+        nonlocal requests, requests_size, entries, failed
+        try:
+            batches.append((await submit_batch(requests), entries))
+        except Exception as e:
+            print(f"Failed to submit batch of {len(requests)} PDFs: {e}")
+            failed += len(requests)
+        requests, requests_size, entries = [], 0, {}
+    
+    for start in range(0, len(pdf_files), MAX_QUEUED_PDFS):
+        chunk = pdf_files[start:start + MAX_QUEUED_PDFS]
+        prepared_pdfs = await asyncio.gather(
+            *[loop.run_in_executor(pool, prepare, p) for p in chunk],
+            return_exceptions=True,
+        )
+        
+        for index, (pdf_path, prepared) in enumerate(zip(chunk, prepared_pdfs), start):
+            try:
+                if isinstance(prepared, Exception):
+                    raise prepared
+                cache_file = get_cache_file(prepared.digest, model_name, request_kind)
+                cached = await asyncio.to_thread(read_cache, cache_file)
+                if cached:
+                    txt_filename = await asyncio.to_thread(save_result, pdf_path, cached)
+                    print(f"Created {txt_filename} from cache")
+                    successful += 1
+                    continue
+                # Batch custom IDs only allow [a-zA-Z0-9_-], so map PDFs by index rather than filename
+                custom_id = f"pdf-{index}"
+                request = {"custom_id": custom_id, "params": build_message_params(prepared, model_name, always_pdf)}
+            except Exception as e:
+                print(f"Failed to prepare {pdf_path.name}: {e}")
+                failed += 1
+                continue
+            
+            request_size = len(pydantic_core.to_json(request))
+            if requests and (len(requests) == MAX_BATCH_REQUESTS or requests_size + request_size > MAX_BATCH_BYTES):
+                await submit()
+            requests.append(request)
+            requests_size += request_size
+            entries[custom_id] = (pdf_path, cache_file)
+    
+    if requests:
+        await submit()
+    
+    invalid = []
+    for batch_id, batch_entries in batches:
+        batch_successful, batch_failed, batch_invalid = await collect_batch(batch_id, batch_entries)
+        successful += batch_successful
+        failed += batch_failed
+        invalid.extend(batch_invalid)
+    
+    # Results that fail validation are rare, so they are retried with direct requests rather than another batch
+    for pdf_path, cache_file in invalid:
+        if not fallback_model_name:
+            failed += 1
+            continue
+        print(f"Retrying {pdf_path.name} with {fallback_model_name}")
+        try:
+            prepared = await loop.run_in_executor(pool, prepare, pdf_path)
+            detail = await api_retry(extract_with_raw)(prepared, fallback_model_name, always_pdf)
+            print(f"Result for {pdf_path.name}:")
+            print(detail)
+            txt_filename = await store_result(pdf_path, cache_file, detail)
+        except Exception as e:
+            print(f"Failed to process {pdf_path.name}: {e}")
+            failed += 1
+            continue
+        print(f"Successfully created {txt_filename} with the JSON response")
+        successful += 1
+    
+    return successful, failed
+
+async def extract_with_agent(prepared: PreparedPdf, model_name: str) -> PublicationDetail:
+    """
+    Extract publication details by running the pydantic_ai agent, which fetches the text with a tool call.
+    
+    Args:
+        prepared: PDF file prepared by prepare_pdf
+        model_name: Name of the model to run the agent with
+    
+    Returns:
+        Validated PublicationDetail object
+    """
+    result = await agent.run(
+        'Process this PDF',
+        deps=prepared,
+        model=get_model(model_name),
+        usage_limits=UsageLimits(
+            response_tokens_limit=300,
+            request_tokens_limit=5000
+        ),
+    )
+    print(result.usage())
+    return result.data
+
+async def extract_with_raw(prepared: PreparedPdf, model_name: str, always_pdf: bool = False) -> PublicationDetail:
+    """
+    Extract publication details with a single Messages API request and a forced tool call.
+    
+    Args:
+        prepared: PDF file prepared by prepare_pdf
+        model_name: Name of the model to process the PDF with
+        always_pdf: Send the first page as a document even if it has usable text
+    
+    Returns:
+        Validated PublicationDetail object
+    """
+    message = await client.messages.create(**build_message_params(prepared, model_name, always_pdf))
+    print(message.usage)
+    return parse_message(message)
+
+# Extraction backends selectable with --backend, called as extract(prepared, model_name)
+Extractor = Callable[[PreparedPdf, str], Awaitable[PublicationDetail]]
+BACKENDS = {
+    'agent': extract_with_agent,
+    'raw': extract_with_raw,
+}
+
+# Messages API requests made by one extraction, which is what --rpm actually limits.
+# The agent makes one request for the get_pdf_content tool call and a second for its result.
+BACKEND_REQUESTS = {
+    'agent': 2,
+    'raw': 1,
+}
+
+@api_retry
+async def run_extract(
+    extract: Extractor,
+    prepared: PreparedPdf,
+    limiter: AsyncLimiter,
+    model_name: str,
+    requests_per_extraction: int = 1,
+) -> PublicationDetail:
+    """
+    Run an extraction under the rate limiter, retrying transient API errors.
+    
+    Args:
+        extract: Extraction backend
+        prepared: PDF file prepared by prepare_pdf
+        limiter: Rate limiter of API requests shared by all extractions
+        model_name: Name of the model to process the PDF with
+        requests_per_extraction: Number of API requests the extraction makes
+    
+    Returns:
+        Validated PublicationDetail object
+    """
+    await limiter.acquire(requests_per_extraction)
+    return await extract(prepared, model_name)
+
+async def process_pdf(
+    prepared: PreparedPdf,
+    extract: Extractor,
+    limiter: AsyncLimiter,
+    model_name: str,
+    fallback_model_name: Optional[str] = None,
+    requests_per_extraction: int = 1,
+    request_kind: str = 'agent',
+) -> Optional[PublicationDetail]:
     """
     Process a single PDF file and extract publication details.
     
     Args:
-        pdf_path: Path to the PDF file
+        prepared: PDF file prepared by prepare_pdf
+        extract: Extraction backend
+        limiter: Rate limiter of API requests shared by all extractions
+        model_name: Name of the model to process the PDF with
+        fallback_model_name: Name of the model to retry with if the result fails validation
+        requests_per_extraction: Number of API requests the extraction backend makes
+        request_kind: Request kind of the extraction backend, from get_request_kind
     
     Returns:
         PublicationDetail object or None if processing failed
     """
+    pdf_path = prepared.path
     try:
-        result = await agent.run(
-            'Process this PDF',
-            deps=str(pdf_path),
-            usage_limits=UsageLimits(
-                response_tokens_limit=300, 
-                request_tokens_limit=5000
-            ),
-        )
+        cache_file = get_cache_file(prepared.digest, model_name, request_kind)
+        cached = await asyncio.to_thread(read_cache, cache_file)
+        if cached:
+            txt_filename = await asyncio.to_thread(save_result, pdf_path, cached)
+            print(f"Created {txt_filename} from cache")
+            return cached
+        
+        try:
+            detail = await run_extract(extract, prepared, limiter, model_name, requests_per_extraction)
+        except (UnexpectedModelBehavior, ValidationError) as e:
+            if not fallback_model_name:
+                raise
+            print(f"Retrying {pdf_path.name} with {fallback_model_name}: {e}")
+            detail = await run_extract(extract, prepared, limiter, fallback_model_name, requests_per_extraction)
         
         print(f"Result for {pdf_path.name}:")
-        print(result.data)
-        print(result.usage())
+        print(detail)
         
         # Save result to txt file
-        txt_filename = pdf_path.with_suffix('.txt')
-        with open(txt_filename, 'w') as txt_file:
-            json.dump({
-                "publication": result.data.publication_name,
-                "date": result.data.date,
-                "headline": result.data.headline
-            }, txt_file, indent=2)
+        txt_filename = await store_result(pdf_path, cache_file, detail)
         print(f"Successfully created {txt_filename} with the JSON response")
         
-        return result.data
+        return detail
     except Exception as e:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         tb = traceback.extract_tb(exc_traceback)
@@ -111,6 +807,69 @@ async def process_pdf(pdf_path: Path) -> Optional[PublicationDetail]:
         traceback.print_exc()
         return None
 
+async def process_pipeline(
+    pdf_files: List[Path],
+    pool: ProcessPoolExecutor,
+    extract: Extractor,
+    concurrency: int,
+    rpm: int,
+    model_name: str,
+    fallback_model_name: Optional[str] = None,
+    with_first_page: bool = False,
+    always_pdf: bool = False,
+    requests_per_extraction: int = 1,
+    request_kind: str = 'agent',
+) -> Tuple[int, int]:
+    """
+    Prepare PDF files in a process pool while concurrently extracting details from prepared files.
+    
+    Args:
+        pdf_files: PDF files to process
+        pool: Process pool used to prepare the PDF files
+        extract: Extraction backend
+        concurrency: Number of extractions in flight at once
+        rpm: Maximum number of API requests started per minute
+        model_name: Name of the model to process the PDFs with
+        fallback_model_name: Name of the model to retry with if a result fails validation
+        with_first_page: Extract the first page of PDFs that are uploaded, for the raw backend
+        always_pdf: Upload every PDF even if it has usable text
+        requests_per_extraction: Number of API requests the extraction backend makes, counted against rpm
+        request_kind: Request kind of the extraction backend, from get_request_kind
+    
+    Returns:
+        Tuple of (successful, failed) counts
+    """
+    loop = asyncio.get_running_loop()
+    prepare = partial(prepare_pdf, with_first_page=with_first_page, always_pdf=always_pdf)
+    limiter = AsyncLimiter(rpm, 60)
+    # Bounded so that preparation can only run MAX_QUEUED_PDFS ahead of the extractions
+    queue: asyncio.Queue = asyncio.Queue(maxsize=MAX_QUEUED_PDFS)
+    results: List[Optional[PublicationDetail]] = []
+    
+    async def produce() -> None:
+        for pdf_path in pdf_files:
+            await queue.put((pdf_path, loop.run_in_executor(pool, prepare, pdf_path)))
+        for _ in range(concurrency):
+            await queue.put(None)
+    
+    async def consume() -> None:
+        while (item := await queue.get()) is not None:
+            pdf_path, prepared = item
+            try:
+                result = await process_pdf(
+                    await prepared, extract, limiter, model_name, fallback_model_name,
+                    requests_per_extraction, request_kind,
+                )
+            except Exception as e:
+                print(f"Failed to prepare {pdf_path.name}: {e}")
+                result = None
+            results.append(result)
+    
+    await asyncio.gather(produce(), *[consume() for _ in range(concurrency)])
+    
+    successful = sum(1 for result in results if result)
+    return successful, len(results) - successful
+
 def get_pdf_files(directory: Path, offset: int = 0, count: Optional[int] = None) -> List[Path]:
     """
     Get a list of PDF files from the specified directory.
@@ -139,13 +898,41 @@ def get_pdf_files(directory: Path, offset: int = 0, count: Optional[int] = None)
         
     return pdf_files
 
+def positive_int(value: str) -> int:
+    """
+    Parse a command line argument that must be a positive integer.
+    
+    Args:
+        value: Argument value as given on the command line
+    
+    Returns:
+        Parsed integer
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
 async def main():
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Process PDF files and extract information using Claude')
     parser.add_argument('--count', type=int, default=None, help='Number of PDFs to process')
     parser.add_argument('--offset', type=int, default=0, help='Number of PDFs to skip')
     parser.add_argument('--dir', type=str, default="pdfs", help='Directory containing PDF files')
+    parser.add_argument('--force', action='store_true', help='Reprocess PDFs that already have a .txt file')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='agent', help='How to extract the details: pydantic_ai agent or a single raw API request')
+    parser.add_argument('--batch', action='store_true', help='Submit the PDFs to the Message Batches API using raw requests')
+    parser.add_argument('--always-pdf', action='store_true', help='For raw and batch requests, upload the PDF even when its text can be extracted')
+    parser.add_argument('--concurrency', type=positive_int, default=8, help='Maximum number of PDFs processed at once')
+    parser.add_argument('--rpm', type=positive_int, default=50, help='Maximum number of API requests started per minute')
+    parser.add_argument('--model', type=str, default=DEFAULT_MODEL, help='Claude model used to extract the details')
+    parser.add_argument('--fallback-model', type=str, default=DEFAULT_FALLBACK_MODEL, help='Model to retry with when a result fails validation (empty to disable)')
     args = parser.parse_args()
+    if not args.batch and args.rpm < BACKEND_REQUESTS[args.backend]:
+        parser.error(f"--rpm must be at least {BACKEND_REQUESTS[args.backend]} for the {args.backend} backend")
     
     # Get PDF files to process
     pdf_dir = Path(args.dir)
@@ -155,18 +942,42 @@ async def main():
         print(f"Error: {e}")
         return
     
-    successful = 0
-    failed = 0
+    # Skip PDFs processed by a previous run
+    skipped = 0
+    if not args.force:
+        pending = []
+        for pdf_path in pdf_files:
+            if pdf_path.with_suffix('.txt').exists():
+                print(f"Skipping {pdf_path.name}, already processed")
+                skipped += 1
+            else:
+                pending.append(pdf_path)
+        pdf_files = pending
     
-    # Process each PDF file
-    for pdf_path in pdf_files:
-        result = await process_pdf(pdf_path)
-        if result:
-            successful += 1
-        else:
-            failed += 1
+    try:
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+            if args.batch:
+                successful, failed = await process_batch(
+                    pdf_files, pool, args.model, args.fallback_model, args.always_pdf
+                )
+            else:
+                extract = BACKENDS[args.backend]
+                if args.backend == 'raw':
+                    extract = partial(extract, always_pdf=args.always_pdf)
+                successful, failed = await process_pipeline(
+                    pdf_files, pool, extract, args.concurrency, args.rpm, args.model, args.fallback_model,
+                    with_first_page=args.backend == 'raw',
+                    always_pdf=args.always_pdf,
+                    requests_per_extraction=BACKEND_REQUESTS[args.backend],
+                    request_kind=get_request_kind(args.backend, args.always_pdf),
+                )
+    finally:
+        await http_client.aclose()
     
-    print(f"Processing complete. Successful: {successful}, Failed: {failed}")
+    print(f"Processing complete. Successful: {successful}, Failed: {failed}, Skipped: {skipped}")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if uvloop:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
\ No newline at end of file